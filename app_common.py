@@ -0,0 +1,324 @@
+"""Document fetching, caching and sheet helpers shared by app.py and desktop_app.py.
+
+The CLI scripts import the sheet helpers from here as well; their own fetch
+and cache code lives in cli_common.py.
+"""
+
+import io
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.etree.ElementTree import ParseError, iterparse
+
+import requests
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.xml.constants import REL_NS, SHEET_MAIN_NS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fast_text import (
+    PREDAL_MARKER,
+    PREDAL_MARKER_LEN,
+    PREDAL_STRIP_CHARS,
+    extract_predal_from_chunks,
+)
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    # Optional C parser; find_predal falls back to the stdlib HTMLParser.
+    LexborHTMLParser = None
+
+
+UA = "Mozilla/5.0 (compatible; lagardere_app/1.0)"
+MAX_WORKERS = 16
+CHUNK_SEPARATOR = "\x1f"
+CACHE_PATH = Path.home() / ".lagardere_cache.sqlite"
+CACHE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS predal (url TEXT PRIMARY KEY, value TEXT, fetched_at INTEGER)"
+)
+NEGATIVE_CACHE_TTL = 24 * 60 * 60
+
+HYPERLINK_TAG = f"{{{SHEET_MAIN_NS}}}hyperlink"
+ROW_TAG = f"{{{SHEET_MAIN_NS}}}row"
+REL_ID_ATTR = f"{{{REL_NS}}}id"
+HYPERLINK_REL_TYPE = f"{REL_NS}/hyperlink"
+SHEET_DATA_OPEN_RE = re.compile(rb"<(?:[\w.-]+:)?sheetData\b[^>]*?(/?)>")
+SHEET_DATA_CLOSE_RE = re.compile(rb"</(?:[\w.-]+:)?sheetData\s*>")
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+
+def html_to_chunks(html: str) -> List[str]:
+    root = LexborHTMLParser(html).root
+    if root is None:
+        return []
+    text = root.text(separator=CHUNK_SEPARATOR, strip=True)
+    return [chunk for chunk in text.split(CHUNK_SEPARATOR) if chunk]
+
+
+class _StopParsing(Exception):
+    pass
+
+
+class PredalFinder(HTMLParser):
+    # Applies the extract_predal_from_chunks rules to text nodes as they are
+    # parsed and aborts the parse on the first answer, so no chunk list is kept.
+    def __init__(self) -> None:
+        super().__init__()
+        self.result: Optional[str] = None
+        self._value_next = False
+
+    def handle_data(self, data: str) -> None:
+        data = data.strip()
+        if not data:
+            return
+        if self._value_next:
+            self._value_next = False
+            if not data.endswith(":"):
+                self._finish(data)
+        if "П" not in data and "п" not in data:
+            return
+        idx = data.upper().find(PREDAL_MARKER)
+        if idx == -1:
+            return
+        after = data[idx + PREDAL_MARKER_LEN:].lstrip(PREDAL_STRIP_CHARS)
+        if after:
+            self._finish(after)
+        self._value_next = True
+
+    def _finish(self, value: str) -> None:
+        self.result = value
+        raise _StopParsing
+
+
+def find_predal(html: str) -> Optional[str]:
+    if LexborHTMLParser is not None:
+        return extract_predal_from_chunks(html_to_chunks(html))
+
+    finder = PredalFinder()
+    try:
+        finder.feed(html)
+        finder.close()
+    except Exception:
+        # _StopParsing on a hit; otherwise best-effort, keep what was found.
+        pass
+    return finder.result
+
+
+def build_session() -> requests.Session:
+    # One pooled session shared by all fetch threads, so keep-alive
+    # connections (and TLS handshakes) are reused across documents.
+    session = requests.Session()
+    session.headers.update({"User-Agent": UA})
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = build_session()
+
+
+def fetch_html(url: str, timeout: float) -> Tuple[str, str]:
+    # Stream so a non-HTML response is rejected on its headers alone,
+    # without downloading or charset-sniffing the body.
+    with _SESSION.get(url, timeout=timeout, stream=True) as resp:
+        resp.raise_for_status()
+        content_type = resp.headers.get("Content-Type", "")
+        if "text/html" not in content_type:
+            return "", content_type
+        raw = resp.content
+        if "charset=" in content_type.lower():
+            encoding = resp.encoding
+        else:
+            encoding = resp.apparent_encoding
+    try:
+        return raw.decode(encoding or "utf-8", errors="replace"), content_type
+    except LookupError:
+        return raw.decode("utf-8", errors="replace"), content_type
+
+
+def resolve_predal(url: str, timeout: float, delay: float = 0.0) -> Optional[str]:
+    # "" means the page had no 'ПРЕДАЛ'; None means the fetch itself failed.
+    try:
+        html, content_type = fetch_html(url, timeout)
+        if "text/html" not in content_type:
+            return ""
+        return find_predal(html) or ""
+    except Exception:
+        return None
+    finally:
+        if delay:
+            time.sleep(delay)
+
+
+def open_cache(path: Path = CACHE_PATH) -> sqlite3.Connection:
+    try:
+        db = sqlite3.connect(path)
+        db.execute(CACHE_SCHEMA)
+    except sqlite3.Error:
+        # Unwritable home directory: keep going with a throwaway cache.
+        db = sqlite3.connect(":memory:")
+        db.execute(CACHE_SCHEMA)
+    return db
+
+
+def cache_lookup(db: sqlite3.Connection, url: str) -> Optional[str]:
+    try:
+        row = db.execute(
+            "SELECT value, fetched_at FROM predal WHERE url = ?", (url,)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    value, fetched_at = row
+    # Empty values are negative entries; retry them once they go stale.
+    if not value and time.time() - fetched_at > NEGATIVE_CACHE_TTL:
+        return None
+    return value
+
+
+def cache_store(db: sqlite3.Connection, url: str, value: str) -> bool:
+    # One short transaction per entry: both apps (and concurrent Streamlit
+    # sessions) share the cache file, so no write lock is held across fetches.
+    try:
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO predal (url, value, fetched_at) VALUES (?, ?, ?)",
+                (url, value, int(time.time())),
+            )
+    except sqlite3.Error:
+        # Locked or unwritable: the results are still returned, just not kept.
+        return False
+    return True
+
+
+def resolve_links(
+    links: List[str],
+    timeout: float,
+    delay: float,
+    on_progress: Callable[[int, int], None],
+) -> Dict[str, str]:
+    db = open_cache()
+    try:
+        results: Dict[str, str] = {}
+        pending: List[str] = []
+        for link in links:
+            value = cache_lookup(db, link)
+            if value is None:
+                pending.append(link)
+            else:
+                results[link] = value
+
+        total = len(links)
+        done = len(results)
+        if done:
+            on_progress(done, total)
+        # At most ~200 UI updates per run; per-link updates flood the event loop.
+        step = max(1, total // 200)
+
+        # Threads only wait on sockets here; size the pool to the work (and to the
+        # session's connection pool) rather than always starting MAX_WORKERS.
+        # A pause between requests only spaces them out with a single worker.
+        workers = 1 if delay > 0 else min(MAX_WORKERS, len(pending)) or 1
+        caching = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(resolve_predal, link, timeout, delay): link
+                for link in pending
+            }
+            for future in as_completed(futures):
+                link = futures[future]
+                value = future.result()
+                results[link] = value or ""
+                if value is not None and caching:
+                    caching = cache_store(db, link, value)
+                done += 1
+                if done % step == 0 or done == total:
+                    on_progress(done, total)
+        return results
+    finally:
+        db.close()
+
+
+def build_header_map(ws) -> Dict[str, int]:
+    # Plain values only: avoids building cell objects for the header row.
+    first_row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    return {
+        str(value).strip(): column
+        for column, value in enumerate(first_row, start=1)
+        if value is not None
+    }
+
+
+def strip_sheet_data(src) -> bytes:
+    # <hyperlinks> follows <sheetData> in the worksheet part, so cut the cell
+    # data out with a byte scan and leave ElementTree a small document.
+    buf = b""
+    while True:
+        chunk = src.read(SCAN_CHUNK_SIZE)
+        buf += chunk
+        match = SHEET_DATA_OPEN_RE.search(buf)
+        if match or not chunk:
+            break
+    if match is None or match.group(1):
+        return buf + src.read()
+
+    head = buf[: match.start()]
+    buf = buf[match.end():]
+    while True:
+        match = SHEET_DATA_CLOSE_RE.search(buf)
+        if match:
+            return head + buf[match.end():] + src.read()
+        chunk = src.read(SCAN_CHUNK_SIZE)
+        if not chunk:
+            return head + buf
+        buf = buf[-64:] + chunk
+
+
+def collect_hyperlinks(src, targets: Dict[str, str]) -> Dict[Tuple[int, int], str]:
+    links: Dict[Tuple[int, int], str] = {}
+    for _event, elem in iterparse(src):
+        if elem.tag == HYPERLINK_TAG:
+            target = targets.get(elem.get(REL_ID_ATTR))
+            if target:
+                for coord in CellRange(elem.get("ref")).cells:
+                    links[coord] = target
+        elif elem.tag == ROW_TAG:
+            elem.clear()
+    return links
+
+
+def load_hyperlinks(wb, ws) -> Dict[Tuple[int, int], str]:
+    # Read-only worksheets do not expose cell.hyperlink, so resolve the
+    # sheet's <hyperlink> entries against its relationships part directly.
+    archive = wb._archive
+    rels_path = get_rels_path(ws._worksheet_path)
+    if rels_path not in archive.namelist():
+        return {}
+    targets = {
+        rel.Id: rel.Target
+        for rel in get_dependents(archive, rels_path)
+        if rel.Type == HYPERLINK_REL_TYPE
+    }
+    if not targets:
+        return {}
+
+    with archive.open(ws._worksheet_path) as src:
+        data = strip_sheet_data(src)
+    try:
+        return collect_hyperlinks(io.BytesIO(data), targets)
+    except ParseError:
+        # Unexpected markup around <sheetData>: parse the whole part instead.
+        with archive.open(ws._worksheet_path) as src:
+            return collect_hyperlinks(src, targets)
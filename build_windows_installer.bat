@@ -20,6 +20,9 @@ call ".venv\Scripts\activate.bat"
 python -m pip install --upgrade pip
 pip install -r requirements.txt
 
+rem Optional: compile the text helpers in place; the pure-Python fast_text.py is used if this fails
+pip install mypy && mypyc fast_text.py || echo mypyc unavailable, using pure-Python fast_text
+
 if not exist "icon.ico" (
   python - <<'PY'
 from PIL import Image
@@ -0,0 +1,277 @@
+"""Document fetching, parsing and caching shared by extract_predal.py and lagardere_table.py."""
+
+import hashlib
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    # Optional C parser; html_to_chunks falls back to the stdlib HTMLParser.
+    LexborHTMLParser = None
+
+
+UA = "Mozilla/5.0 (compatible; lagardere_cli/1.0)"
+DEFAULT_CONCURRENCY = 20
+CHUNK_SEPARATOR = "\x1f"
+CACHE_PATH = Path.home() / ".lagardere_cli_cache.sqlite"
+CACHE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS predal_docs (url TEXT, cookie TEXT, value TEXT, "
+    "fetched_at INTEGER, PRIMARY KEY (url, cookie))"
+)
+NEGATIVE_CACHE_TTL = 24 * 60 * 60
+FLUSH_EVERY = 50
+# Marker plus the rest of its chunk once the separators after it are skipped.
+_PREDAL_RE = re.compile("ПРЕДАЛ[ :\u00a0]*([^\x1f]*)", re.IGNORECASE)
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.chunks: List[str] = []
+
+    def handle_data(self, data: str) -> None:
+        data = data.strip()
+        if data:
+            self.chunks.append(data)
+
+
+def extract_predal_from_chunks(chunks: List[str]) -> Optional[str]:
+    text = CHUNK_SEPARATOR.join(chunks)
+    for match in _PREDAL_RE.finditer(text):
+        # Same chunk (e.g. "ПРЕДАЛ: Иван Иванов")
+        if match.group(1):
+            return match.group(1)
+        # Otherwise, look at the next chunk
+        start = match.end() + 1
+        if start > len(text):
+            continue
+        end = text.find(CHUNK_SEPARATOR, start)
+        next_chunk = (text[start:] if end == -1 else text[start:end]).strip()
+        if next_chunk and not next_chunk.endswith(":"):
+            return next_chunk
+    return None
+
+
+def html_to_chunks(html: str) -> List[str]:
+    if LexborHTMLParser is not None:
+        root = LexborHTMLParser(html).root
+        if root is None:
+            return []
+        text = root.text(separator=CHUNK_SEPARATOR, strip=True)
+        return [chunk for chunk in text.split(CHUNK_SEPARATOR) if chunk]
+
+    parser = TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # Best-effort parsing
+        pass
+    return parser.chunks
+
+
+def build_session() -> requests.Session:
+    # One pooled session shared by the fetch threads, so keep-alive
+    # connections (and TLS handshakes) are reused across documents.
+    session = requests.Session()
+    # Compressed HTML is a fraction of the bytes on the wire; urllib3 decodes
+    # it transparently and only lists codecs it can decode (br with brotli).
+    session.headers.update({"User-Agent": UA, "Accept-Encoding": DEFAULT_ACCEPT_ENCODING})
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = build_session()
+
+
+def fetch_html(url: str, cookie: Optional[str], timeout: float) -> Tuple[bytes, str, str]:
+    headers = {"Cookie": cookie} if cookie else None
+    with _SESSION.get(url, headers=headers, timeout=timeout, stream=True) as resp:
+        resp.raise_for_status()
+        content_type = resp.headers.get("Content-Type", "")
+        if "text/html" not in content_type:
+            return b"", content_type, ""
+        # requests reports ISO-8859-1 for any text/* without a charset.
+        charset = resp.encoding if "charset=" in content_type.lower() else None
+        raw = resp.content
+    return raw, content_type, charset or "utf-8"
+
+
+def decode_html(raw: bytes, charset: str) -> str:
+    try:
+        return raw.decode(charset, errors="replace")
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")
+
+
+@lru_cache(maxsize=None)
+def predal_pattern(charset: str) -> Optional[re.Pattern]:
+    # The marker in any mix of case, as bytes in the page's charset.
+    try:
+        if "<".encode(charset) != b"<":
+            # UTF-16/32 and friends: encoded letters would carry a BOM.
+            return None
+        return re.compile(
+            b"".join(
+                b"(?:%s|%s)" % (re.escape(c.encode(charset)), re.escape(c.lower().encode(charset)))
+                for c in "ПРЕДАЛ"
+            )
+        )
+    except (LookupError, UnicodeError):
+        return None
+
+
+def may_contain_predal(raw: bytes, charset: str) -> bool:
+    # Cheap byte scan so pages without the marker skip decoding and parsing.
+    # Character references (&#1055; or &Pcy;) can spell the marker, and
+    # unknown charsets can't be encoded, so those pages are always parsed.
+    if b"&#" in raw or b"cy;" in raw:
+        return True
+    pattern = predal_pattern(charset.lower())
+    if pattern is None:
+        return True
+    return pattern.search(raw) is not None
+
+
+def open_cache(path: str) -> sqlite3.Connection:
+    try:
+        db = sqlite3.connect(path)
+        db.execute(CACHE_SCHEMA)
+    except sqlite3.Error as exc:
+        print(f"Cache unavailable ({exc}); continuing without it.", file=sys.stderr)
+        db = sqlite3.connect(":memory:")
+        db.execute(CACHE_SCHEMA)
+    return db
+
+
+def cookie_key(cookie: Optional[str]) -> str:
+    # Cache entries record which cookie fetched them without storing it.
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest() if cookie else ""
+
+
+def cache_lookup(db: sqlite3.Connection, url: str, cookie: str) -> Optional[str]:
+    # A found value holds whatever cookie fetched it, but an empty one may be a
+    # login page, so negative entries only count for the same cookie.
+    try:
+        row = db.execute(
+            "SELECT value, fetched_at FROM predal_docs"
+            " WHERE url = ? AND (cookie = ? OR value != '') ORDER BY value = '' LIMIT 1",
+            (url, cookie),
+        ).fetchone()
+    except sqlite3.Error as exc:
+        print(f"Cache read failed for {url} ({exc}); fetching it.", file=sys.stderr)
+        return None
+    if row is None:
+        return None
+    value, fetched_at = row
+    # Empty values are negative entries; retry them once they go stale.
+    if not value and time.time() - fetched_at > NEGATIVE_CACHE_TTL:
+        return None
+    return value
+
+
+def cache_store(db: sqlite3.Connection, url: str, cookie: str, value: str) -> bool:
+    # One short transaction per entry: both scripts share the cache file, so a
+    # write lock held across fetches would lock the other run out.
+    try:
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO predal_docs (url, cookie, value, fetched_at)"
+                " VALUES (?, ?, ?, ?)",
+                (url, cookie, value, int(time.time())),
+            )
+    except sqlite3.Error as exc:
+        print(f"Cache write failed ({exc}); continuing without caching.", file=sys.stderr)
+        return False
+    return True
+
+
+def _parse_predal(raw: bytes, charset: str) -> Optional[str]:
+    # Module level so ProcessPoolExecutor workers can unpickle it.
+    return extract_predal_from_chunks(html_to_chunks(decode_html(raw, charset)))
+
+
+def read_predal(future: Future) -> Optional[str]:
+    # Parses a finished fetch on the calling thread; re-raises fetch errors.
+    raw, content_type, charset = future.result()
+    if "text/html" in content_type and may_contain_predal(raw, charset):
+        return _parse_predal(raw, charset)
+    return None
+
+
+def fetch_predal(
+    url: str, cookie: Optional[str], timeout: float, parse_pool: ProcessPoolExecutor
+) -> Optional[str]:
+    # Runs on a fetch thread: only pages that pass the byte prefilter are
+    # shipped to a parse process, and the thread waits for the answer.
+    raw, content_type, charset = fetch_html(url, cookie, timeout)
+    if "text/html" not in content_type or not may_contain_predal(raw, charset):
+        return None
+    return parse_pool.submit(_parse_predal, raw, charset).result()
+
+
+def resolve_links(
+    urls: List[str],
+    cookie: Optional[str],
+    timeout: float,
+    concurrency: int,
+    db: sqlite3.Connection,
+    parse_pool: Optional[ProcessPoolExecutor] = None,
+) -> Iterator[Optional[str]]:
+    # Yields the 'ПРЕДАЛ' value of each URL in order. Misses are fetched by
+    # worker threads a bounded window ahead of the caller, so output can be
+    # written as it resolves without finished pages piling up behind a slow one.
+    workers = max(1, concurrency)
+    window: Deque[Tuple[str, Optional[Future], Optional[str]]] = deque()
+    cache_cookie = cookie_key(cookie)
+    caching = True
+
+    def drain(limit: int) -> Iterator[Optional[str]]:
+        nonlocal caching
+        while window and (len(window) > limit or window[0][1] is None):
+            url, future, value = window.popleft()
+            if future is not None:
+                try:
+                    value = read_predal(future) if parse_pool is None else future.result()
+                except Exception as exc:
+                    # Failed fetches are not cached, so the next run retries them.
+                    print(f"Failed to fetch {url}: {exc}", file=sys.stderr)
+                    yield None
+                    continue
+                if caching:
+                    caching = cache_store(db, url, cache_cookie, value or "")
+            yield value
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for url in urls:
+            value = cache_lookup(db, url, cache_cookie)
+            if value is None:
+                if parse_pool is None:
+                    future = pool.submit(fetch_html, url, cookie, timeout)
+                else:
+                    future = pool.submit(fetch_predal, url, cookie, timeout, parse_pool)
+                window.append((url, future, None))
+            else:
+                window.append((url, None, value or None))
+            yield from drain(2 * workers)
+        yield from drain(0)
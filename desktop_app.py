@@ -2,17 +2,18 @@
 """Desktop app (PyQt6) for extracting 'ПРЕДАЛ' and building a filtered table."""
 
 import os
-import time
-from datetime import date, datetime
-from html.parser import HTMLParser
+from collections import defaultdict
+from itertools import groupby
 from typing import Dict, List, Optional, Tuple
 
-import requests
 from openpyxl import Workbook, load_workbook
+from openpyxl.cell import Cell, WriteOnlyCell
 from openpyxl.styles import PatternFill
+from openpyxl.utils import get_column_letter
 from PyQt6 import QtCore, QtGui, QtWidgets
 
-UA = "Mozilla/5.0 (compatible; lagardere_desktop/1.0)"
+from app_common import build_header_map, load_hyperlinks, resolve_links
+from fast_text import clean_predal, format_cell, normalize_product, parse_quantity
 
 PRODUCT_ORDER = [
     "PAZ X-Freeze",
@@ -71,83 +72,7 @@ BRAND_PRODUCTS = {
     "RIOT Capsule": PRODUCT_ORDER[28:40],
 }
 
-
-class TextExtractor(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.chunks: List[str] = []
-
-    def handle_data(self, data: str) -> None:
-        data = data.strip()
-        if data:
-            self.chunks.append(data)
-
-
-def html_to_chunks(html: str) -> List[str]:
-    parser = TextExtractor()
-    try:
-        parser.feed(html)
-        parser.close()
-    except Exception:
-        pass
-    return parser.chunks
-
-
-def extract_predal_from_chunks(chunks: List[str]) -> Optional[str]:
-    upper_chunks = [c.upper() for c in chunks]
-    for i, chunk_upper in enumerate(upper_chunks):
-        if "ПРЕДАЛ" in chunk_upper:
-            original = chunks[i]
-            idx = original.upper().find("ПРЕДАЛ")
-            after = original[idx + len("ПРЕДАЛ"):]
-            after = after.lstrip(" :\u00a0")
-            if after:
-                return after
-            if i + 1 < len(chunks):
-                next_chunk = chunks[i + 1].strip()
-                if next_chunk and not next_chunk.endswith(":"):
-                    return next_chunk
-    return None
-
-
-def clean_predal(value: str) -> str:
-    if not value:
-        return ""
-    text = value.strip()
-    marker = "(име, фамилия, подпис):"
-    lower = text.lower()
-    idx = lower.find(marker)
-    if idx != -1:
-        text = (text[:idx] + text[idx + len(marker):]).strip()
-    return text.strip(" :\u00a0")
-
-
-def fetch_html(url: str, timeout: float) -> Tuple[str, str]:
-    headers = {"User-Agent": UA}
-    resp = requests.get(url, headers=headers, timeout=timeout)
-    resp.raise_for_status()
-    content_type = resp.headers.get("Content-Type", "")
-    resp.encoding = resp.apparent_encoding or resp.encoding
-    return resp.text, content_type
-
-
-def build_header_map(ws) -> Dict[str, int]:
-    header_map: Dict[str, int] = {}
-    for cell in ws[1]:
-        if cell.value is None:
-            continue
-        header_map[str(cell.value).strip()] = cell.column
-    return header_map
-
-
-def format_cell(value) -> str:
-    if value is None:
-        return ""
-    if isinstance(value, datetime):
-        return value.strftime("%Y-%m-%d")
-    if isinstance(value, date):
-        return value.strftime("%Y-%m-%d")
-    return str(value).strip()
+_PRODUCT_INDEX = {normalize_product(p): idx for idx, p in enumerate(PRODUCT_ORDER)}
 
 
 def load_rows(
@@ -159,48 +84,57 @@ def load_rows(
     product_header: str = "Наименование на продукта",
     quantity_header: str = "Количество",
 ) -> List[Tuple[str, str, str, str, str, Optional[str]]]:
-    wb = load_workbook(xlsx_path)
-    ws = wb.active
-
-    header_map = build_header_map(ws)
-
-    def col(name: str, default: int) -> int:
-        return header_map.get(name, default)
-
-    number_col = col(number_header, 2)
-    client_col = col(client_header, 4)
-    date_col = col(date_header, 6)
-    product_col = col(product_header, 8)
-    quantity_col = col(quantity_header, 10)
-
-    rows: List[Tuple[str, str, str, str, str, Optional[str]]] = []
-    prefix = client_prefix.strip().lower()
-
-    for r in range(2, ws.max_row + 1):
-        client = ws.cell(row=r, column=client_col).value
-        if client is None:
-            continue
-        client_str = str(client).strip()
-        if not client_str.lower().startswith(prefix):
-            continue
-
-        number_cell = ws.cell(row=r, column=number_col)
-        number = number_cell.value
-        if number is None:
-            continue
-        number_str = format_cell(number)
-
-        date_str = format_cell(ws.cell(row=r, column=date_col).value)
-        product_str = format_cell(ws.cell(row=r, column=product_col).value)
-        qty_str = format_cell(ws.cell(row=r, column=quantity_col).value)
-
-        link = None
-        if number_cell.hyperlink and number_cell.hyperlink.target:
-            link = number_cell.hyperlink.target
-        elif isinstance(number_cell.value, str) and number_cell.value.startswith("http"):
-            link = number_cell.value
-
-        rows.append((number_str, client_str, date_str, product_str, qty_str, link))
+    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        ws.reset_dimensions()
+        header_map = build_header_map(ws)
+
+        def col(name: str, default: int) -> int:
+            return header_map.get(name, default)
+
+        number_col = col(number_header, 2)
+        client_col = col(client_header, 4)
+        date_col = col(date_header, 6)
+        product_col = col(product_header, 8)
+        quantity_col = col(quantity_header, 10)
+        last_col = max(number_col, client_col, date_col, product_col, quantity_col)
+
+        hyperlinks = load_hyperlinks(wb, ws)
+
+        rows: List[Tuple[str, str, str, str, str, Optional[str]]] = []
+        prefix = client_prefix.strip().lower()
+        number_idx = number_col - 1
+        client_idx = client_col - 1
+        date_idx = date_col - 1
+        product_idx = product_col - 1
+        quantity_idx = quantity_col - 1
+
+        rows_iter = ws.iter_rows(min_row=2, max_col=last_col, values_only=True)
+        for r, values in enumerate(rows_iter, start=2):
+            client = values[client_idx]
+            if client is None:
+                continue
+            client_str = str(client).strip()
+            if not client_str.lower().startswith(prefix):
+                continue
+
+            number = values[number_idx]
+            if number is None:
+                continue
+            number_str = format_cell(number)
+
+            date_str = format_cell(values[date_idx])
+            product_str = format_cell(values[product_idx])
+            qty_str = format_cell(values[quantity_idx])
+
+            link = hyperlinks.get((r, number_col))
+            if not link and isinstance(number, str) and number.startswith("http"):
+                link = number
+
+            rows.append((number_str, client_str, date_str, product_str, qty_str, link))
+    finally:
+        wb.close()
 
     return rows
 
@@ -208,8 +142,7 @@ def load_rows(
 def build_output(
     output_path: str, rows: List[Tuple[str, str, str, str, str, Optional[str]]]
 ) -> None:
-    wb = Workbook()
-    ws_default = wb.active
+    wb = Workbook(write_only=True)
     brand_fill = PatternFill(start_color="FFA500", end_color="FFA500", fill_type="solid")
 
     def safe_title(name: str, existing: set) -> str:
@@ -227,130 +160,122 @@ def build_output(
         existing.add(title)
         return title
 
-    def autosize_worksheet(ws) -> None:
-        for col in ws.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value is None:
-                    continue
-                val = str(cell.value)
-                if len(val) > max_len:
-                    max_len = len(val)
-            if max_len:
-                ws.column_dimensions[col_letter].width = min(60, max_len + 2)
-
-    def append_row_with_link(
-        ws,
-        row_data: Tuple[str, str, str, str, str, Optional[str]],
-    ) -> None:
-        number, predal, date_str, product, qty, link = row_data
-        ws.append([number, predal, date_str, product, qty])
-        if link:
-            cell = ws.cell(row=ws.max_row, column=1)
-            cell.hyperlink = link
-            cell.style = "Hyperlink"
-
-    # Preserve order of appearance for colleagues
-    colleague_order: List[str] = []
-    by_colleague: Dict[str, List[Tuple[str, str, str, str, str, Optional[str]]]] = {}
-    for row in rows:
-        name = row[1].strip() if row[1].strip() else "Неизвестен"
-        if name not in by_colleague:
-            by_colleague[name] = []
-            colleague_order.append(name)
-        by_colleague[name].append(row)
+    def add_row(sheet_rows: List[list], widths: List[int], values: list) -> None:
+        # Track the widest value per column while the sheet is laid out, so
+        # widths can be set before the rows are streamed out.
+        sheet_rows.append(values)
+        for idx, value in enumerate(values):
+            if isinstance(value, Cell):
+                value = value.value
+            if value is None:
+                continue
+            length = len(str(value))
+            if idx >= len(widths):
+                widths.extend([0] * (idx + 1 - len(widths)))
+            if length > widths[idx]:
+                widths[idx] = length
+
+    def link_cell(ws, value: str, link: str) -> Cell:
+        cell = WriteOnlyCell(ws, value=value)
+        cell.hyperlink = link
+        cell.style = "Hyperlink"
+        return cell
+
+    def filled_cells(ws, values: list) -> List[Cell]:
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.fill = brand_fill
+            cells.append(cell)
+        return cells
+
+    def colleague_of(row: Tuple[str, str, str, str, str, Optional[str]]) -> str:
+        return row[1].strip() or "Неизвестен"
+
+    # Preserve order of appearance for colleagues: a stable sort on the index
+    # of each name's first row makes each colleague's rows contiguous for groupby.
+    order_idx = {name: idx for idx, name in enumerate(dict.fromkeys(map(colleague_of, rows)))}
+    rows_sorted = sorted(rows, key=lambda r: order_idx[colleague_of(r)])
 
     existing_titles = set()
-    for name in colleague_order:
+    for name, group in groupby(rows_sorted, key=colleague_of):
+        colleague_rows = list(group)
         ws = wb.create_sheet(title=safe_title(name, existing_titles))
-        ws.append(["Номер", "Предал", "Дата", "Продукт", "Количество"])
-        for row in by_colleague[name]:
-            append_row_with_link(ws, row)
-
-        date_headers, summary_rows = build_summary_for_colleague(by_colleague[name])
-        ws.append([])
-        ws.append(["Обобщение по продукт"])
-        ws.append(["Продукт", *date_headers])
+        sheet_rows: List[list] = []
+        widths: List[int] = []
+        add_row(sheet_rows, widths, ["Номер", "Предал", "Дата", "Продукт", "Количество"])
+        for number, predal, date_str, product, qty, link in colleague_rows:
+            number_value = link_cell(ws, number, link) if link else number
+            add_row(sheet_rows, widths, [number_value, predal, date_str, product, qty])
+
+        date_headers, summary_rows = build_summary_for_colleague(colleague_rows)
+        add_row(sheet_rows, widths, [])
+        add_row(sheet_rows, widths, ["Обобщение по продукт"])
+        add_row(sheet_rows, widths, ["Продукт", *date_headers])
         for product, totals in summary_rows:
-            ws.append([product, *totals])
-            if product == "":
-                row_idx = ws.max_row
-                for col_idx in range(1, len(totals) + 2):
-                    ws.cell(row=row_idx, column=col_idx).fill = brand_fill
-        autosize_worksheet(ws)
-
-    # Remove default empty sheet
-    wb.remove(ws_default)
-    wb.save(output_path)
-
-
-def parse_quantity(value: str) -> Optional[float]:
-    text = value.strip()
-    if not text:
-        return None
-    text = text.replace(" ", "")
-    if "," in text and "." in text:
-        text = text.replace(",", "")
-    elif "," in text:
-        text = text.replace(",", ".")
-    try:
-        return float(text)
-    except ValueError:
-        return None
+            values = [product, *totals]
+            add_row(sheet_rows, widths, filled_cells(ws, values) if product == "" else values)
 
+        # Write-only sheets accept column widths only before the first row.
+        for idx, max_len in enumerate(widths, start=1):
+            if max_len:
+                ws.column_dimensions[get_column_letter(idx)].width = min(60, max_len + 2)
+        for values in sheet_rows:
+            ws.append(values)
 
-def normalize_product(value: str) -> str:
-    text = value.strip().lower()
-    while "  " in text:
-        text = text.replace("  ", " ")
-    return text
+    wb.save(output_path)
 
 
 def build_summary_for_colleague(
     rows: List[Tuple[str, str, str, str, str, Optional[str]]]
 ) -> Tuple[List[str], List[Tuple[str, List[float]]]]:
-    product_map = {normalize_product(p): p for p in PRODUCT_ORDER}
-    totals: Dict[Tuple[str, str], float] = {}
-    date_set: set = set()
+    # totals[product_idx][date_id]; date ids are handed out in order of first
+    # appearance and the columns are reordered once the dates are known.
+    totals: List[List[float]] = [[] for _ in PRODUCT_ORDER]
+    date_ids: Dict[str, int] = {}
 
     for _num, _predal, date_str, product, qty, _link in rows:
-        if date_str:
-            date_set.add(str(date_str))
-        prod_key = normalize_product(product)
-        if prod_key not in product_map:
+        date_key = str(date_str) if date_str else ""
+        if not date_key:
+            continue
+        date_id = date_ids.get(date_key)
+        if date_id is None:
+            date_id = date_ids[date_key] = len(date_ids)
+            for column in totals:
+                column.append(0.0)
+        prod_idx = _PRODUCT_INDEX.get(normalize_product(product))
+        if prod_idx is None:
             continue
-        prod = product_map[prod_key]
         amount = parse_quantity(qty)
         if amount is None:
             continue
-        key = (prod, str(date_str) if date_str else "")
-        totals[key] = totals.get(key, 0.0) + amount
+        totals[prod_idx][date_id] += amount
 
-    date_headers = sorted(date_set)
+    date_headers = sorted(date_ids)
     if not date_headers:
         date_headers = ["Дата"]
 
     def format_num(value: float):
         return int(value) if value.is_integer() else value
 
-    def totals_for_products(products: List[str]) -> List[float]:
-        sums: List[float] = []
-        for date_val in date_headers:
-            sums.append(sum(totals.get((p, date_val), 0.0) for p in products))
-        return sums
+    # One row of per-date totals per product; brand rows are column sums of these.
+    if date_ids:
+        order = [date_ids[date_val] for date_val in date_headers]
+        product_totals = {
+            prod: [by_date[date_id] for date_id in order]
+            for prod, by_date in zip(PRODUCT_ORDER, totals)
+        }
+    else:
+        product_totals = {prod: [0.0] for prod in PRODUCT_ORDER}
 
     summary_rows: List[Tuple[str, List[float]]] = []
     for prod in PRODUCT_ORDER:
-        row_totals: List[float] = []
-        for date_val in date_headers:
-            val = totals.get((prod, date_val), 0.0)
-            row_totals.append(format_num(val))
-        summary_rows.append((prod, row_totals))
+        summary_rows.append((prod, [format_num(v) for v in product_totals[prod]]))
 
         if prod in BRAND_BOUNDARIES:
             brand = BRAND_BOUNDARIES[prod]
-            brand_totals = totals_for_products(BRAND_PRODUCTS[brand])
+            brand_rows = [product_totals[p] for p in BRAND_PRODUCTS[brand]]
+            brand_totals = [sum(column) for column in zip(*brand_rows)]
             summary_rows.append(("", [format_num(v) for v in brand_totals]))
 
     return date_headers, summary_rows
@@ -384,32 +309,26 @@ class Worker(QtCore.QObject):
                 self.error.emit("Няма редове за този клиент.")
                 return
 
-            url_cache: Dict[str, Optional[str]] = {}
-            output_rows: List[Tuple[str, str, str, str, str, Optional[str]]] = []
-            total = len(rows)
-
-            for i, (number, _client, date_str, product_str, qty_str, link) in enumerate(
-                rows, start=1
-            ):
-                predal = ""
-                if link:
-                    if link in url_cache:
-                        predal = url_cache[link] or ""
-                    else:
-                        try:
-                            html, content_type = fetch_html(link, self.timeout)
-                            if "text/html" in content_type:
-                                chunks = html_to_chunks(html)
-                                predal = extract_predal_from_chunks(chunks) or ""
-                            predal = clean_predal(predal)
-                            url_cache[link] = predal
-                        except Exception:
-                            url_cache[link] = ""
-                    if self.delay:
-                        time.sleep(self.delay)
-
-                output_rows.append((number, predal, date_str, product_str, qty_str, link))
-                self.progress.emit(i, total)
+            # Group rows by link so each document is fetched (and its value
+            # cleaned) once, then fan the result back out to all of its rows.
+            by_link: Dict[str, List[int]] = defaultdict(list)
+            for idx, row in enumerate(rows):
+                if row[5]:
+                    by_link[row[5]].append(idx)
+            url_cache = resolve_links(list(by_link), self.timeout, self.delay, self.progress.emit)
+
+            predals = [""] * len(rows)
+            for link, indexes in by_link.items():
+                predal = clean_predal(url_cache[link])
+                for idx in indexes:
+                    predals[idx] = predal
+
+            output_rows: List[Tuple[str, str, str, str, str, Optional[str]]] = [
+                (number, predal, date_str, product_str, qty_str, link)
+                for (number, _client, date_str, product_str, qty_str, link), predal in zip(
+                    rows, predals
+                )
+            ]
 
             build_output(self.output_path, output_rows)
             missing = sum(1 for _n, p, _d, _pr, _q, _l in output_rows if not p)
@@ -7,73 +7,21 @@ linked document, parses the name after 'ПРЕДАЛ:', and writes a two-column
 
 import argparse
 import csv
+import multiprocessing
 import sys
-import time
-import urllib.request
-from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Optional, Tuple
 
 from openpyxl import load_workbook
 
-
-UA = "Mozilla/5.0 (compatible; extract_predal/1.0)"
-
-
-class TextExtractor(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.chunks: List[str] = []
-
-    def handle_data(self, data: str) -> None:
-        data = data.strip()
-        if data:
-            self.chunks.append(data)
-
-
-def extract_predal_from_chunks(chunks: List[str]) -> Optional[str]:
-    upper_chunks = [c.upper() for c in chunks]
-    for i, chunk_upper in enumerate(upper_chunks):
-        if "ПРЕДАЛ" in chunk_upper:
-            original = chunks[i]
-            # Try to extract from same chunk (e.g. "ПРЕДАЛ: Иван Иванов")
-            idx = original.upper().find("ПРЕДАЛ")
-            after = original[idx + len("ПРЕДАЛ"):]
-            after = after.lstrip(" :\u00a0")
-            if after:
-                return after
-            # Otherwise, look at the next chunk
-            if i + 1 < len(chunks):
-                next_chunk = chunks[i + 1].strip()
-                if next_chunk and not next_chunk.endswith(":"):
-                    return next_chunk
-    return None
-
-
-def html_to_chunks(html: str) -> List[str]:
-    parser = TextExtractor()
-    try:
-        parser.feed(html)
-        parser.close()
-    except Exception:
-        # Best-effort parsing
-        pass
-    return parser.chunks
-
-
-def fetch_html(url: str, cookie: Optional[str], timeout: float) -> Tuple[str, str]:
-    headers = {"User-Agent": UA}
-    if cookie:
-        headers["Cookie"] = cookie
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        content_type = resp.headers.get("Content-Type", "")
-        charset = resp.headers.get_content_charset() or "utf-8"
-        raw = resp.read()
-        try:
-            text = raw.decode(charset, errors="replace")
-        except LookupError:
-            text = raw.decode("utf-8", errors="replace")
-    return text, content_type
+from app_common import load_hyperlinks
+from cli_common import (
+    CACHE_PATH,
+    DEFAULT_CONCURRENCY,
+    FLUSH_EVERY,
+    open_cache,
+    resolve_links,
+)
 
 
 def load_links(
@@ -81,38 +29,45 @@ def load_links(
     sheet: Optional[str],
     number_header: str,
 ) -> List[Tuple[str, str]]:
-    wb = load_workbook(xlsx_path)
-    ws = wb[sheet] if sheet else wb.active
-
-    header_row = 1
-    header_map = {}
-    for cell in ws[header_row]:
-        if cell.value:
-            header_map[str(cell.value).strip()] = cell.column
-
-    number_col = header_map.get(number_header, 2)  # default column B
-
-    seen = set()
-    results: List[Tuple[str, str]] = []
-
-    for row in range(header_row + 1, ws.max_row + 1):
-        cell = ws.cell(row=row, column=number_col)
-        doc_number = cell.value
-        if doc_number is None:
-            continue
-        doc_number = str(doc_number).strip()
-        if not doc_number or doc_number in seen:
-            continue
-
-        link = None
-        if cell.hyperlink and cell.hyperlink.target:
-            link = cell.hyperlink.target
-        elif isinstance(cell.value, str) and cell.value.startswith("http"):
-            link = cell.value
-
-        if link:
-            results.append((doc_number, link))
-            seen.add(doc_number)
+    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.active
+        ws.reset_dimensions()
+
+        header_row = 1
+        header_map = {}
+        first_row = next(
+            ws.iter_rows(min_row=header_row, max_row=header_row, values_only=True), ()
+        )
+        for column, value in enumerate(first_row, start=1):
+            if value:
+                header_map[str(value).strip()] = column
+
+        number_col = header_map.get(number_header, 2)  # default column B
+        number_idx = number_col - 1
+        hyperlinks = load_hyperlinks(wb, ws)
+
+        seen = set()
+        results: List[Tuple[str, str]] = []
+
+        rows_iter = ws.iter_rows(min_row=header_row + 1, max_col=number_col, values_only=True)
+        for row, values in enumerate(rows_iter, start=header_row + 1):
+            value = values[number_idx]
+            if value is None:
+                continue
+            doc_number = str(value).strip()
+            if not doc_number or doc_number in seen:
+                continue
+
+            link = hyperlinks.get((row, number_col))
+            if not link and isinstance(value, str) and value.startswith("http"):
+                link = value
+
+            if link:
+                results.append((doc_number, link))
+                seen.add(doc_number)
+    finally:
+        wb.close()
 
     return results
 
@@ -145,10 +100,26 @@ def main() -> int:
         help="Request timeout in seconds",
     )
     parser.add_argument(
-        "--delay",
-        type=float,
-        default=0.0,
-        help="Delay between requests in seconds",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Number of documents fetched in parallel (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Parse documents in this many worker processes (0: parse in the main process)",
+    )
+    parser.add_argument(
+        "--cache-db",
+        default=str(CACHE_PATH),
+        help=f"SQLite file caching resolved documents (default: {CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Fetch every document again without reading or writing the cache",
     )
     parser.add_argument(
         "--include-link",
@@ -167,45 +138,48 @@ def main() -> int:
         print("No hyperlinks found in the number column.", file=sys.stderr)
         return 1
 
+    urls = list(dict.fromkeys(url for _, url in links))
     url_cache: Dict[str, Optional[str]] = {}
-    results: List[Tuple[str, Optional[str], str]] = []
-
-    for doc_number, url in links:
-        if url in url_cache:
-            predal = url_cache[url]
-        else:
-            try:
-                html, content_type = fetch_html(url, args.cookie, args.timeout)
-                if "text/html" not in content_type:
-                    predal = None
-                else:
-                    chunks = html_to_chunks(html)
-                    predal = extract_predal_from_chunks(chunks)
-                url_cache[url] = predal
-            except Exception as exc:
-                print(f"Failed to fetch {url}: {exc}", file=sys.stderr)
-                predal = None
-                url_cache[url] = predal
-
-        results.append((doc_number, predal, url))
-        if args.delay:
-            time.sleep(args.delay)
-
-    with open(args.output, "w", newline="", encoding="utf-8") as out_f:
-        writer = csv.writer(out_f)
-        header = ["Номер", "Предал"]
-        if args.include_link:
-            header.append("Линк")
-        writer.writerow(header)
-        for doc_number, predal, url in results:
-            row = [doc_number, predal or ""]
+    missing = 0
+    db = open_cache(":memory:" if args.no_cache else args.cache_db)
+    parse_pool = None
+    if args.parse_workers > 0:
+        # Spawned, not forked: the pool starts workers lazily from fetch
+        # threads, and forking a threaded process can deadlock the child.
+        parse_pool = ProcessPoolExecutor(
+            args.parse_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    try:
+        resolved = resolve_links(
+            urls, args.cookie, args.timeout, args.concurrency, db, parse_pool
+        )
+        # Rows are written as their documents resolve, so partial output
+        # survives an interrupted run.
+        with open(args.output, "w", newline="", encoding="utf-8") as out_f:
+            writer = csv.writer(out_f)
+            header = ["Номер", "Предал"]
             if args.include_link:
-                row.append(url)
-            writer.writerow(row)
+                header.append("Линк")
+            writer.writerow(header)
+            for count, (doc_number, url) in enumerate(links, start=1):
+                if url not in url_cache:
+                    url_cache[url] = next(resolved)
+                predal = url_cache[url]
+                if not predal:
+                    missing += 1
+                row = [doc_number, predal or ""]
+                if args.include_link:
+                    row.append(url)
+                writer.writerow(row)
+                if count % FLUSH_EVERY == 0:
+                    out_f.flush()
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        db.close()
 
-    missing = sum(1 for _, predal, _ in results if not predal)
     print(
-        f"Processed {len(results)} documents. Missing 'Предал' for {missing} docs."
+        f"Processed {len(links)} documents. Missing 'Предал' for {missing} docs."
     )
     return 0
 
@@ -0,0 +1,83 @@
+"""Text helpers shared by app.py and desktop_app.py.
+
+These run once per text node or spreadsheet cell, so the module sticks to
+plain typed functions that mypyc can compile. Building it in place with
+``mypyc fast_text.py`` puts a compiled extension next to this file, and
+Python imports that extension in preference to this source.
+"""
+
+import re
+from datetime import date
+from functools import lru_cache
+from typing import List, Optional
+
+PREDAL_MARKER = "ПРЕДАЛ"
+PREDAL_MARKER_LEN = len(PREDAL_MARKER)
+PREDAL_STRIP_CHARS = " :\u00a0"
+SIGNATURE_MARKER = "(име, фамилия, подпис):"
+SIGNATURE_MARKER_LEN = len(SIGNATURE_MARKER)
+
+_SPACE_RE = re.compile(r"\s+")
+# Thousands separators in quantities: plain and non-breaking spaces.
+_SPACE_TABLE = str.maketrans("", "", " \u00a0")
+
+
+def extract_predal_from_chunks(chunks: List[str]) -> Optional[str]:
+    for i, chunk in enumerate(chunks):
+        # Cheap membership test first: most text nodes contain no "П" at all.
+        if "П" not in chunk and "п" not in chunk:
+            continue
+        idx = chunk.upper().find(PREDAL_MARKER)
+        if idx == -1:
+            continue
+        after = chunk[idx + PREDAL_MARKER_LEN:].lstrip(PREDAL_STRIP_CHARS)
+        if after:
+            return after
+        if i + 1 < len(chunks):
+            next_chunk = chunks[i + 1].strip()
+            if next_chunk and not next_chunk.endswith(":"):
+                return next_chunk
+    return None
+
+
+def clean_predal(value: str) -> str:
+    if not value:
+        return ""
+    text = value.strip()
+    idx = text.lower().find(SIGNATURE_MARKER)
+    if idx != -1:
+        text = (text[:idx] + text[idx + SIGNATURE_MARKER_LEN:]).strip()
+    return text.strip(PREDAL_STRIP_CHARS)
+
+
+@lru_cache(maxsize=4096)
+def _format_date(value: date) -> str:
+    return value.strftime("%Y-%m-%d")
+
+
+def format_cell(value: object) -> str:
+    if value is None:
+        return ""
+    # datetime is a date subclass; both format to the same day string.
+    if isinstance(value, date):
+        return _format_date(value)
+    return str(value).strip()
+
+
+def parse_quantity(value: str) -> Optional[float]:
+    text = value.translate(_SPACE_TABLE).strip()
+    if not text:
+        return None
+    if "," in text and "." in text:
+        text = text.replace(",", "")
+    elif "," in text:
+        text = text.replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def normalize_product(value: str) -> str:
+    return _SPACE_RE.sub(" ", value.strip().lower())
@@ -10,79 +10,23 @@ E: Количество
 """
 
 import argparse
+import multiprocessing
 import os
 import sys
-import time
-import urllib.request
-from html.parser import HTMLParser
-from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from openpyxl import Workbook, load_workbook
 
-UA = "Mozilla/5.0 (compatible; lagardere_table/1.0)"
-
-
-class TextExtractor(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.chunks: List[str] = []
-
-    def handle_data(self, data: str) -> None:
-        data = data.strip()
-        if data:
-            self.chunks.append(data)
-
-
-def extract_predal_from_chunks(chunks: List[str]) -> Optional[str]:
-    upper_chunks = [c.upper() for c in chunks]
-    for i, chunk_upper in enumerate(upper_chunks):
-        if "ПРЕДАЛ" in chunk_upper:
-            original = chunks[i]
-            idx = original.upper().find("ПРЕДАЛ")
-            after = original[idx + len("ПРЕДАЛ"):]
-            after = after.lstrip(" :\u00a0")
-            if after:
-                return after
-            if i + 1 < len(chunks):
-                next_chunk = chunks[i + 1].strip()
-                if next_chunk and not next_chunk.endswith(":"):
-                    return next_chunk
-    return None
-
-
-def html_to_chunks(html: str) -> List[str]:
-    parser = TextExtractor()
-    try:
-        parser.feed(html)
-        parser.close()
-    except Exception:
-        pass
-    return parser.chunks
-
-
-def fetch_html(url: str, cookie: Optional[str], timeout: float) -> Tuple[str, str]:
-    headers = {"User-Agent": UA}
-    if cookie:
-        headers["Cookie"] = cookie
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        content_type = resp.headers.get("Content-Type", "")
-        charset = resp.headers.get_content_charset() or "utf-8"
-        raw = resp.read()
-        try:
-            text = raw.decode(charset, errors="replace")
-        except LookupError:
-            text = raw.decode("utf-8", errors="replace")
-    return text, content_type
-
-
-def build_header_map(ws) -> Dict[str, int]:
-    header_map: Dict[str, int] = {}
-    for cell in ws[1]:
-        if cell.value is None:
-            continue
-        header_map[str(cell.value).strip()] = cell.column
-    return header_map
+from app_common import build_header_map, load_hyperlinks
+from cli_common import (
+    CACHE_PATH,
+    DEFAULT_CONCURRENCY,
+    FLUSH_EVERY,
+    open_cache,
+    resolve_links,
+)
 
 
 def load_rows(
@@ -95,62 +39,73 @@ def load_rows(
     quantity_header: str,
     client_prefix: str,
 ) -> List[Tuple[str, str, str, str, str, Optional[str]]]:
-    wb = load_workbook(xlsx_path)
-    ws = wb[sheet] if sheet else wb.active
-
-    header_map = build_header_map(ws)
-
-    def col(name: str, default: int) -> int:
-        return header_map.get(name, default)
-
-    number_col = col(number_header, 2)
-    client_col = col(client_header, 4)
-    date_col = col(date_header, 6)
-    product_col = col(product_header, 8)
-    quantity_col = col(quantity_header, 10)
-
-    rows: List[Tuple[str, str, str, str, str, Optional[str]]] = []
-    prefix = client_prefix.strip().lower()
-
-    for r in range(2, ws.max_row + 1):
-        client = ws.cell(row=r, column=client_col).value
-        if client is None:
-            continue
-        client_str = str(client).strip()
-        if not client_str.lower().startswith(prefix):
-            continue
+    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.active
+        ws.reset_dimensions()
 
-        number_cell = ws.cell(row=r, column=number_col)
-        number = number_cell.value
-        if number is None:
-            continue
-        number_str = str(number).strip()
+        header_map = build_header_map(ws)
 
-        date_val = ws.cell(row=r, column=date_col).value
-        date_str = "" if date_val is None else str(date_val).strip()
+        def col(name: str, default: int) -> int:
+            return header_map.get(name, default)
 
-        product_val = ws.cell(row=r, column=product_col).value
-        product_str = "" if product_val is None else str(product_val).strip()
+        number_col = col(number_header, 2)
+        client_col = col(client_header, 4)
+        date_col = col(date_header, 6)
+        product_col = col(product_header, 8)
+        quantity_col = col(quantity_header, 10)
+        last_col = max(number_col, client_col, date_col, product_col, quantity_col)
 
-        qty_val = ws.cell(row=r, column=quantity_col).value
-        qty_str = "" if qty_val is None else str(qty_val).strip()
+        hyperlinks = load_hyperlinks(wb, ws)
 
-        link = None
-        if number_cell.hyperlink and number_cell.hyperlink.target:
-            link = number_cell.hyperlink.target
-        elif isinstance(number_cell.value, str) and number_cell.value.startswith("http"):
-            link = number_cell.value
+        rows: List[Tuple[str, str, str, str, str, Optional[str]]] = []
+        prefix = client_prefix.strip().casefold()
+        prefix_len = len(prefix)
+        # All five columns come out of each row tuple in one C-level call.
+        pick = itemgetter(
+            number_col - 1, client_col - 1, date_col - 1, product_col - 1, quantity_col - 1
+        )
 
-        rows.append((number_str, client_str, date_str, product_str, qty_str, link))
+        rows_iter = ws.iter_rows(min_row=2, max_col=last_col, values_only=True)
+        for r, values in enumerate(rows_iter, start=2):
+            number, client, date_val, product_val, qty_val = pick(values)
+            if client is None:
+                continue
+            if not isinstance(client, str):
+                client = str(client)
+            elif client[:1].isspace():
+                client = client.lstrip()
+            # Only the head of the value can match; casefold never shortens
+            # text, so the slice is enough and rejected rows allocate little.
+            if not client[:prefix_len].casefold().startswith(prefix):
+                continue
+            client_str = client.rstrip()
+
+            if number is None:
+                continue
+            number_str = str(number).strip()
+
+            date_str = "" if date_val is None else str(date_val).strip()
+            product_str = "" if product_val is None else str(product_val).strip()
+            qty_str = "" if qty_val is None else str(qty_val).strip()
+
+            link = hyperlinks.get((r, number_col))
+            if not link and isinstance(number, str) and number.startswith("http"):
+                link = number
+
+            rows.append((number_str, client_str, date_str, product_str, qty_str, link))
+    finally:
+        wb.close()
 
     return rows
 
 
-def write_output(output_path: str, rows: List[Tuple[str, str, str, str, str]]) -> None:
+def write_output(output_path: str, rows: Iterable[Tuple[str, str, str, str, str]]) -> None:
     if output_path.lower().endswith(".xlsx"):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Lagardere"
+        # Write-only mode streams each appended row to a temporary file
+        # instead of keeping every cell in memory until save.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title="Lagardere")
         ws.append(["Номер", "Предал", "Дата", "Продукт", "Количество"])
         for row in rows:
             ws.append(list(row))
@@ -161,7 +116,12 @@ def write_output(output_path: str, rows: List[Tuple[str, str, str, str, str]]) -
         with open(output_path, "w", newline="", encoding="utf-8") as out_f:
             writer = csv.writer(out_f)
             writer.writerow(["Номер", "Предал", "Дата", "Продукт", "Количество"])
-            writer.writerows(rows)
+            # Rows may still be resolving; flush so partial output survives an
+            # interrupted run.
+            for count, row in enumerate(rows, start=1):
+                writer.writerow(row)
+                if count % FLUSH_EVERY == 0:
+                    out_f.flush()
 
 
 def main() -> int:
@@ -196,7 +156,28 @@ def main() -> int:
         help="Environment variable name holding the Cookie header value",
     )
     parser.add_argument("--timeout", type=float, default=20.0, help="Request timeout")
-    parser.add_argument("--delay", type=float, default=0.0, help="Delay between requests")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of documents fetched in parallel",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Parse documents in this many worker processes (0: parse in the main process)",
+    )
+    parser.add_argument(
+        "--cache-db",
+        default=str(CACHE_PATH),
+        help=f"SQLite file caching resolved documents (default: {CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Fetch every document again without reading or writing the cache",
+    )
 
     args = parser.parse_args()
 
@@ -230,33 +211,41 @@ def main() -> int:
         print("No matching rows for the client prefix.", file=sys.stderr)
         return 1
 
+    links = list(dict.fromkeys(row[5] for row in rows if row[5]))
     url_cache: Dict[str, Optional[str]] = {}
-    output_rows = []
-
-    for number, _client, date_str, product_str, qty_str, link in rows:
-        predal = None
-        if link:
-            if link in url_cache:
+    missing = 0
+
+    def output_rows(resolved: Iterator[Optional[str]]) -> Iterator[Tuple[str, str, str, str, str]]:
+        nonlocal missing
+        for number, _client, date_str, product_str, qty_str, link in rows:
+            predal = None
+            if link:
+                if link not in url_cache:
+                    url_cache[link] = next(resolved)
                 predal = url_cache[link]
-            else:
-                try:
-                    html, content_type = fetch_html(link, cookie, args.timeout)
-                    if "text/html" in content_type:
-                        chunks = html_to_chunks(html)
-                        predal = extract_predal_from_chunks(chunks)
-                    url_cache[link] = predal
-                except Exception as exc:
-                    print(f"Failed to fetch {link}: {exc}", file=sys.stderr)
-                    url_cache[link] = None
-            if args.delay:
-                time.sleep(args.delay)
-
-        output_rows.append((number, predal or "", date_str, product_str, qty_str))
-
-    write_output(args.output, output_rows)
-
-    missing = sum(1 for _n, p, _d, _pr, _q in output_rows if not p)
-    print(f"Wrote {len(output_rows)} rows. Missing 'Предал' for {missing} rows.")
+            if not predal:
+                missing += 1
+            yield (number, predal or "", date_str, product_str, qty_str)
+
+    db = open_cache(":memory:" if args.no_cache else args.cache_db)
+    parse_pool = None
+    if args.parse_workers > 0:
+        # Spawned, not forked: the pool starts workers lazily from fetch
+        # threads, and forking a threaded process can deadlock the child.
+        parse_pool = ProcessPoolExecutor(
+            args.parse_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    try:
+        resolved = resolve_links(
+            links, cookie, args.timeout, args.concurrency, db, parse_pool
+        )
+        write_output(args.output, output_rows(resolved))
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        db.close()
+
+    print(f"Wrote {len(rows)} rows. Missing 'Предал' for {missing} rows.")
     return 0
 
 
@@ -4,8 +4,12 @@
 import argparse
 import csv
 import glob
+import io
 import sys
-from typing import List
+from operator import itemgetter
+from typing import BinaryIO, List
+
+COPY_CHUNK_SIZE = 1024 * 1024
 
 
 def load_files(input_glob: str) -> List[str]:
@@ -15,31 +19,91 @@ def load_files(input_glob: str) -> List[str]:
     return files
 
 
+def read_header(line: bytes) -> List[str]:
+    return next(csv.reader([line.decode("utf-8")]), [])
+
+
+def copy_reordered(
+    in_f: BinaryIO,
+    out_f: BinaryIO,
+    file_headers: List[str],
+    headers: List[str],
+    newline: bytes,
+) -> int:
+    # Same columns in a different order: these rows have to go through csv.
+    width = len(file_headers)
+    reorder = itemgetter(*(file_headers.index(name) for name in headers))
+    count = 0
+
+    def reordered(reader):
+        nonlocal count
+        for row in reader:
+            count += 1
+            if not row:
+                yield row
+                continue
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            yield reorder(row)
+
+    text_in = io.TextIOWrapper(in_f, encoding="utf-8", newline="")
+    text_out = io.TextIOWrapper(out_f, encoding="utf-8", newline="")
+    try:
+        writer = csv.writer(text_out, lineterminator=newline.decode())
+        writer.writerows(reordered(csv.reader(text_in)))
+    finally:
+        text_out.detach()
+        text_in.detach()
+    return count
+
+
 def merge_csvs(input_glob: str, output_path: str, preview_rows: int) -> None:
     files = load_files(input_glob)
 
     headers = None
+    newline = b"\r\n"
     total_rows = 0
 
-    with open(output_path, "w", newline="", encoding="utf-8") as out_f:
-        writer = None
-
+    # Headers are parsed and compared; the rows themselves are copied as raw
+    # bytes, so nothing is decoded or re-quoted on the way through.
+    with open(output_path, "wb") as out_f:
         for path in files:
-            with open(path, "r", newline="", encoding="utf-8") as in_f:
-                reader = csv.reader(in_f)
-                file_headers = next(reader, None)
-                if file_headers is None:
+            with open(path, "rb") as in_f:
+                header_line = in_f.readline()
+                if not header_line:
                     continue
+                file_headers = read_header(header_line)
 
                 if headers is None:
                     headers = file_headers
-                    writer = csv.writer(out_f)
-                    writer.writerow(headers)
+                    if header_line.endswith(b"\n"):
+                        newline = b"\r\n" if header_line.endswith(b"\r\n") else b"\n"
+                    else:
+                        header_line += newline
+                    out_f.write(header_line)
                 elif file_headers != headers:
-                    raise ValueError(f"Header mismatch in {path}")
+                    if sorted(file_headers) != sorted(headers) or len(set(headers)) != len(headers):
+                        raise ValueError(f"Header mismatch in {path}")
+                    total_rows += copy_reordered(in_f, out_f, file_headers, headers, newline)
+                    continue
 
-                for row in reader:
-                    writer.writerow(row)
+                last = b"\n"
+                quoted = 0
+                while True:
+                    chunk = in_f.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out_f.write(chunk)
+                    # Newlines inside quoted fields do not end a row: only count
+                    # the ones between quotes, carrying the quote state over.
+                    parts = chunk.split(b'"')
+                    total_rows += sum(part.count(b"\n") for part in parts[quoted::2])
+                    quoted ^= (len(parts) - 1) & 1
+                    last = chunk[-1:]
+                if last != b"\n":
+                    # Unterminated last row: end it so the next file starts
+                    # on a line of its own.
+                    out_f.write(newline)
                     total_rows += 1
 
     print(f"Merged {len(files)} files, {total_rows} rows -> {output_path}")
@@ -56,7 +120,9 @@ def merge_csvs(input_glob: str, output_path: str, preview_rows: int) -> None:
 
 def main() -> int:
     parser = argparse.ArgumentParser(
-        description="Merge CSV files (same headers) and preview the output."
+        description=(
+            "Merge CSV files with the same columns (in any order) and preview the output."
+        )
     )
     parser.add_argument("input_glob", help="Input glob, e.g. './data/*.csv'")
     parser.add_argument("output", help="Output CSV file")